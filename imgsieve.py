@@ -3,11 +3,84 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 import os
-from functools import partial
+from functools import lru_cache, partial
+from itertools import chain, islice
+import sqlite3
 
 import imagehash
+import numpy as np
 from PIL import Image
+import scipy.fft
+
+_BATCH_SIZE = 32
+# Decode threads per worker process. Every CPU already runs a worker,
+# so more threads only add contention once reads are local.
+_PREFETCH = 2
+
+# Number of set bits in every possible byte.
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)],
+                     dtype=np.uint8)
+# Band buckets up to this size are compared pair by pair in Python,
+# where that is cheaper than a numpy call per hash.
+_SMALL_BUCKET = 64
+# Number of 64-bit words compared per numpy call when scanning pairs.
+_BLOCK_WORDS = 1 << 20
+
+
+def _average_hash(pixels, hash_size):
+    return pixels > pixels.mean(axis=(1, 2), keepdims=True)
+
+
+def _phash(pixels, hash_size):
+    dct = scipy.fft.dctn(pixels, axes=(1, 2))
+    dct_low_freq = dct[:, :hash_size, :hash_size]
+    return dct_low_freq > np.median(dct_low_freq, axis=(1, 2), keepdims=True)
+
+
+def _phash_simple(pixels, hash_size):
+    dct = scipy.fft.dct(pixels)
+    dct_low_freq = dct[:, :hash_size, 1:hash_size + 1]
+    return dct_low_freq > dct_low_freq.mean(axis=(1, 2), keepdims=True)
+
+
+def _dhash(pixels, hash_size):
+    return pixels[:, :, 1:] > pixels[:, :, :-1]
+
+
+def _dhash_vertical(pixels, hash_size):
+    return pixels[:, 1:, :] > pixels[:, :-1, :]
+
+
+# Maps each method to a function that hashes a stack of greyscale pixel
+# arrays, and a function giving the (width, height) to resize images to
+# for a hash size. Methods without a size hash each PIL image with
+# imagehash instead.
+_HASH_METHODS = {
+    'ahash': (_average_hash, lambda hash_size: (hash_size, hash_size)),
+    'phash': (_phash, lambda hash_size: (4 * hash_size, 4 * hash_size)),
+    'phash_simple': (_phash_simple,
+                     lambda hash_size: (4 * hash_size, 4 * hash_size)),
+    'dhash': (_dhash, lambda hash_size: (hash_size + 1, hash_size)),
+    'dhash_horizontal': (_dhash, lambda hash_size: (hash_size + 1, hash_size)),
+    'dhash_vertical': (_dhash_vertical,
+                       lambda hash_size: (hash_size, hash_size + 1)),
+    'whash': (imagehash.whash, None),
+    'whash-haar': (imagehash.whash, None),
+    'whash-db4': (partial(imagehash.whash, mode='db4'), None),
+}
+
+_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.gif'})
+# Leading bytes of JPEG, PNG, BMP and GIF files.
+_MAGIC_NUMBERS = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'BM', b'GIF87a',
+                  b'GIF89a')
+
+_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'imgsieve.db')
 
 
 def find_images(directory, recursive=False):
@@ -18,73 +91,422 @@ def find_images(directory, recursive=False):
         recursive: A boolean value that determines whether to
             search all subdirectories for images. Defaults to False.
 
+    Yields:
+        Paths to image files, as they are found. Directories that
+        cannot be read are skipped, as os.walk does.
+
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_file():
+                if os.path.splitext(entry.name)[1].lower() in _EXTENSIONS:
+                    yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                yield from find_images(entry.path, recursive)
+
+
+def _prepare(image_path, size):
+    """Decodes an image into a greyscale pixel array of the given size.
+
+    If size is None, the full size greyscale PIL image is returned.
+    Files that do not start with the header of a supported format are
+    rejected before PIL tries to identify and decode them.
+
+    """
+    with open(image_path, 'rb') as image_file:
+        if not image_file.read(8).startswith(_MAGIC_NUMBERS):
+            raise OSError('not a JPEG, PNG, BMP or GIF file')
+        image_file.seek(0)
+        with Image.open(image_file) as img:
+            img = img.convert('L')
+    if size is None:
+        return img
+    return np.asarray(img.resize(size, Image.LANCZOS))
+
+
+def _prefetch(function, items, window=_PREFETCH):
+    """Maps a function over items, running ahead in background threads.
+
+    Up to window calls are in flight at once, so one image can be
+    decoded while the next is still being read from slow storage.
+
+    """
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _pack(bits):
+    """Packs a boolean hash array into an int, first bit most significant."""
+    bits = bits.ravel()
+    return (int.from_bytes(np.packbits(bits).tobytes(), 'big') >>
+            (-bits.size % 8))
+
+
+def _try_prepare(image_path, size):
+    """Calls _prepare, returning an (image, error) pair instead of raising."""
+    try:
+        return (_prepare(image_path, size), None)
+    except OSError as error:
+        return (None, error)
+
+
+def _hash_batch(image_paths, method, hash_size):
+    """Hashes a batch of images; runs inside a worker process.
+
     Returns:
-        A list of paths to image files that were found.
+        A tuple containing a list of (path, hash) pairs and a list of
+        (path, error message) pairs for images that could not be read.
+
+    """
+    hash_function, size = _HASH_METHODS[method]
+    target = None if size is None else size(hash_size)
+    hashed = []
+    failed = []
+    pixel_paths = []
+    pixels = []
+
+    # wHash images are hashed while later ones decode. Pixel arrays are
+    # all decoded before the batch is hashed in one vectorized call.
+    prepared = _prefetch(partial(_try_prepare, size=target), image_paths)
+    for image_path, (image, error) in zip(image_paths, prepared):
+        if error is not None:
+            failed.append((image_path, str(error)))
+        elif size is None:
+            image_hash = _pack(hash_function(image, hash_size).hash)
+            hashed.append((image_path, image_hash))
+        else:
+            pixel_paths.append(image_path)
+            pixels.append(image)
+
+    if pixels:
+        image_hashes = hash_function(np.stack(pixels), hash_size)
+        hashed.extend(zip(pixel_paths, map(_pack, image_hashes)))
+    return (hashed, failed)
+
+
+def _batches(image_paths):
+    """Groups paths into batches for the worker processes, lazily.
+
+    Enough paths to give every worker a full batch are read up front,
+    so that a small number of images is still spread over every CPU.
 
     """
-    image_paths = []
+    image_paths = iter(image_paths)
+    workers = os.cpu_count() or 1
+    head = list(islice(image_paths, _BATCH_SIZE * workers))
+    batch_size = max(1, min(_BATCH_SIZE, -(-len(head) // workers)))
+    for start in range(0, len(head), batch_size):
+        yield head[start:start + batch_size]
+    while True:
+        batch = list(islice(image_paths, _BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def _open_cache(cache_path):
+    """Opens the hash cache database, creating it if necessary."""
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    connection = sqlite3.connect(cache_path)
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                           ' path TEXT, method TEXT, hash_size INTEGER,'
+                           ' mtime INTEGER, size INTEGER, hash TEXT,'
+                           ' PRIMARY KEY (path, method, hash_size))')
+    except sqlite3.Error:
+        connection.close()
+        raise
+    return connection
+
+
+def _read_cache(connection, image_paths, method, hash_size, cached, stats):
+    """Looks up the cached hashes of images that are unchanged on disk.
+
+    Cached hashes are appended to cached as (path, hash) pairs, and the
+    stat results of all other images are recorded in stats.
+
+    Yields:
+        Paths of the images that still need to be hashed, including
+        any that could not be stat'ed, so that the worker reports them.
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if (file.endswith('.jpg') or
-                    file.endswith('.jpeg') or
-                    file.endswith('.png') or
-                    file.endswith('.bmp') or
-                    file.endswith('.gif')):
-                image_paths.append(os.path.join(root, file))
+    """
+    for image_path in image_paths:
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            yield image_path
+            continue
+        row = connection.execute(
+            'SELECT hash, mtime, size FROM hashes'
+            ' WHERE path = ? AND method = ? AND hash_size = ?',
+            (os.path.abspath(image_path), method, hash_size)).fetchone()
+        if row is not None and row[1:] == (stat.st_mtime_ns, stat.st_size):
+            cached.append((image_path, int(row[0], 16)))
+        else:
+            stats[image_path] = stat
+            yield image_path
+
+
+def _write_cache(connection, hashed, stats, method, hash_size):
+    """Stores (path, hash) pairs in the cache in a single transaction.
+
+    Images without a stat result from _read_cache are not stored.
+
+    """
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+            [(os.path.abspath(image_path), method, hash_size,
+              stats[image_path].st_mtime_ns, stats[image_path].st_size,
+              format(image_hash, 'x'))
+             for image_path, image_hash in hashed if image_path in stats])
+
+
+if hasattr(int, 'bit_count'):
+    def _hamming(first, second):
+        """Counts the bits that differ between two integer hashes."""
+        return (first ^ second).bit_count()
+else:  # Python < 3.10
+    def _hamming(first, second):
+        """Counts the bits that differ between two integer hashes."""
+        return bin(first ^ second).count('1')
+
+
+def _to_words(hashes, hash_bits):
+    """Splits integer hashes into rows of 64-bit words, highest first."""
+    words = -(-hash_bits // 64)
+    return np.array([[(image_hash >> (64 * word)) & 0xffffffffffffffff
+                      for word in reversed(range(words))]
+                     for image_hash in hashes],
+                    dtype=np.uint64).reshape(len(hashes), words)
+
+
+if hasattr(np, 'bitwise_count'):
+    def _row_distances(words):
+        """Sums the set bits of each row of 64-bit words."""
+        return np.bitwise_count(words).sum(axis=-1)
+else:  # numpy < 2.0
+    def _row_distances(words):
+        """Sums the set bits of each row of 64-bit words."""
+        return _POPCOUNT[words.view(np.uint8)].sum(axis=-1)
+
+
+def _connect(words, threshold):
+    """Groups hashes that are within a Hamming distance of each other.
+
+    Blocks of rows are compared against every later row in a single
+    numpy call, with the block size bounded by _BLOCK_WORDS. Groups are
+    merged by relabelling, so the work per row stays vectorized even
+    when most pairs are within the threshold.
 
-        if not recursive:
-            break
+    Args:
+        words: An array of hashes as rows of 64-bit words.
+        threshold: The maximum number of differing bits.
 
-    return image_paths
+    Returns:
+        An array labelling each row with the index of a row in its
+        group, where every label is also its own row's label.
 
+    """
+    labels = np.arange(len(words))
+    rows = max(1, _BLOCK_WORDS // max(1, words.size))
+    for start in range(0, len(words), rows):
+        block = words[start:start + rows]
+        distances = _row_distances(block[:, None, :] ^ words[None, start:, :])
+        close = np.triu(distances <= threshold, 1)
+        for offset in np.flatnonzero(close.any(axis=1)):
+            label = labels[start + offset]
+            others = labels[np.flatnonzero(close[offset]) + start]
+            others = others[others != label]
+            if len(others):
+                labels[np.isin(labels, others)] = label
+    return labels
+
+
+def _find_similar(image_hashes, hash_bits, threshold):
+    """Groups hashes that are within a Hamming distance of each other.
+
+    Every hash is split into threshold + 1 bands of bits. Two hashes
+    that differ in at most threshold bits must agree on at least one
+    whole band, so only hashes that share a band are ever compared.
+    Hashes in small buckets are compared pair by pair, skipping pairs
+    already in one group; each large bucket is scanned with vectorized
+    XOR and popcount. When the bands are too narrow to be selective,
+    all pairs are scanned once that way instead.
 
-def hash_images(image_paths, method='phash', hash_size=8):
+    Args:
+        image_hashes: A dictionary mapping hash values to image paths.
+        hash_bits: The number of bits in each hash value.
+        threshold: The maximum number of differing bits for two
+            hashes to be considered similar.
+
+    Returns:
+        A dictionary mapping a hash value from each group of similar
+        hashes to the paths of all images in that group, for groups
+        with two or more images.
+
+    """
+    hashes = list(image_hashes)
+    words = _to_words(hashes, hash_bits)
+    parent = list(range(len(hashes)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    bands = threshold + 1
+    # Narrow bands fill every bucket with unrelated hashes, and each band
+    # compares the same pairs again. On random 64-bit hashes, one pass
+    # over all pairs wins once a band has fewer than about 2 * bands
+    # possible values.
+    if 2 ** (hash_bits // bands) < 2 * bands:
+        parent = _connect(words, threshold).tolist()
+        bands = 0
+
+    for band in range(bands):
+        shift = band * hash_bits // bands
+        mask = (1 << ((band + 1) * hash_bits // bands - shift)) - 1
+        buckets = {}
+        for index, image_hash in enumerate(hashes):
+            buckets.setdefault((image_hash >> shift) & mask, []).append(index)
+        for bucket in buckets.values():
+            if len(bucket) > _SMALL_BUCKET:
+                labels = _connect(words[bucket], threshold)
+                for index, label in zip(bucket, labels.tolist()):
+                    parent[find(index)] = find(bucket[label])
+                continue
+            for position, first in enumerate(bucket):
+                for second in bucket[position + 1:]:
+                    root_first, root_second = find(first), find(second)
+                    if (root_first != root_second and
+                            _hamming(hashes[first], hashes[second]) <=
+                            threshold):
+                        parent[root_second] = root_first
+
+    groups = {}
+    for index, image_hash in enumerate(hashes):
+        groups.setdefault(find(index), []).extend(image_hashes[image_hash])
+
+    return {hashes[root]: paths for root, paths in groups.items()
+            if len(paths) > 1}
+
+
+def hash_images(image_paths, method='phash', hash_size=8, threshold=0,
+                cache_path=None):
     """Hashes images using a specified hashing method.
 
+    The images are hashed in parallel across a pool of worker
+    processes, one per CPU. Images that cannot be read are reported
+    and left out of the results. If a cache is given, images whose
+    modification time and size are unchanged since they were last
+    hashed are not hashed again.
+
     Args:
-        image_paths: A list of paths to the images to hash.
+        image_paths: An iterable of paths to the images to hash.
         method: The image hashing method to use. Defaults to 'phash'.
         hash_size: A base image size to use for hashing. Defaults to 8.
+        threshold: The maximum number of bits by which the hashes of
+            two images may differ for them to be considered similar.
+            Defaults to 0, which only matches identical hashes.
+        cache_path: The path to an SQLite database for caching hashes.
+            Defaults to None, which disables caching.
 
     Returns:
-        A tuple containing a dictionary mapping hash values to image
-        paths and another dictionary with only the hash values that
-        are shared between two or more images.
+        A tuple containing a dictionary mapping integer hash values to
+        image paths and another dictionary mapping hash values to the
+        paths of two or more duplicate/similar images.
 
     """
-    if method == 'ahash':
-        hash_function = imagehash.average_hash
-    elif method == 'phash':
-        hash_function = imagehash.phash
-    elif method == 'phash_simple':
-        hash_function = imagehash.phash_simple
-    elif method == 'dhash' or method == 'dhash_horizontal':
-        hash_function = imagehash.dhash
-    elif method == 'dhash_vertical':
-        hash_function = imagehash.dhash_vertical
-    elif method == 'whash' or method == 'whash-haar':
-        hash_function = imagehash.whash
-    elif method == 'whash-db4':
-        hash_function = partial(imagehash.whash, mode='db4')
-    else:
+    if method not in _HASH_METHODS:
         raise ValueError('Invalid hashing method: ' + method)
+    if hash_size < 2:
+        raise ValueError('Hash size must be at least 2')
+    if threshold >= hash_size ** 2:
+        raise ValueError('Threshold must be less than the number of hash'
+                         ' bits: ' + str(hash_size ** 2))
 
     image_hashes = {}
     duplicates = {}
 
-    for image_path in image_paths:
-        with Image.open(image_path) as img:
-            image_hash = hash_function(img, hash_size)
-        if image_hashes.setdefault(image_hash, []):
-            duplicate = duplicates.setdefault(
-                str(image_hash), image_hashes[image_hash][:])
+    # The cache only saves work, so the run goes on without it if the
+    # database cannot be opened or written.
+    cached = []
+    stats = {}
+    connection = None
+    if cache_path is not None:
+        try:
+            connection = _open_cache(cache_path)
+        except (OSError, sqlite3.Error) as error:
+            print('Could not open hash cache', cache_path + ':', error)
+    if connection is None:
+        missing = image_paths
+    else:
+        missing = _read_cache(connection, image_paths, method, hash_size,
+                              cached, stats)
+
+    # Batches are submitted as soon as they fill up, so hashing starts
+    # while image_paths is still being produced. Each finished batch is
+    # cached straight away, so an error later on loses no work.
+    hashed = []
+    try:
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(_hash_batch, batch, method, hash_size)
+                       for batch in _batches(missing)]
+            for future in futures:
+                batch_hashed, failed = future.result()
+                for image_path, error in failed:
+                    print('Could not hash', image_path + ':', error)
+                if connection is not None:
+                    try:
+                        _write_cache(connection, batch_hashed, stats,
+                                     method, hash_size)
+                    except sqlite3.Error as error:
+                        print('Could not update hash cache',
+                              cache_path + ':', error)
+                        connection.close()
+                        connection = None
+                hashed.extend(batch_hashed)
+    finally:
+        if connection is not None:
+            connection.close()
+
+    for image_path, image_hash in cached + hashed:
+        paths = image_hashes.setdefault(image_hash, [])
+        if paths:
+            duplicate = duplicates.get(image_hash)
+            if duplicate is None:
+                duplicate = duplicates[image_hash] = paths[:]
             duplicate.append(image_path)
-        image_hashes[image_hash].append(image_path)
+        paths.append(image_path)
+
+    if threshold > 0:
+        duplicates = _find_similar(image_hashes, hash_size ** 2, threshold)
 
     return (image_hashes, duplicates)
 
 
+@lru_cache(maxsize=None)
+def _pixel_count(image_path):
+    """Reads an image's resolution from its header, without decoding it."""
+    with Image.open(image_path) as img:
+        return img.size[0] * img.size[1]
+
+
 def filter_duplicates(duplicates, mode='resolution'):
     """Filters out duplicates to keep, according to the filter mode.
 
@@ -96,12 +518,8 @@ def filter_duplicates(duplicates, mode='resolution'):
         The list of duplicates that remain after filtering.
 
     """
-    def resolution(image_path):
-        with Image.open(image_path) as img:
-            return img.size[0] * img.size[1]
-
     if mode == 'resolution':
-        highest_res = max(duplicates, key=resolution)
+        highest_res = max(duplicates, key=_pixel_count)
         duplicates.remove(highest_res)
     else:
         raise ValueError('Invalid filter mode: ' + mode)
@@ -127,30 +545,53 @@ def main():
     parser.add_argument('--size', type=int, default=8,
                         help='Base image size to use for hashing'
                         ' (default: %(default)s).')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Hash every image instead of reusing hashes'
+                        ' cached by previous runs.')
+    parser.add_argument('--threshold', type=int, default=0,
+                        help='Maximum number of differing hash bits for'
+                        ' images to count as similar (default: %(default)s).')
     args = parser.parse_args()
 
     image_paths = find_images(args.path, args.recursive)
-    print('Found', len(image_paths), 'images')
-    if not image_paths:
+    first_path = next(image_paths, None)
+    if first_path is None:
+        print('Found 0 images')
         return
 
+    # Paths are counted as hashing consumes them, so the total includes
+    # images that turn out to be unreadable.
+    found = 0
+
+    def counted(image_paths):
+        nonlocal found
+        for image_path in image_paths:
+            found += 1
+            yield image_path
+
     print('Hashing...')
-    image_hashes, duplicates = hash_images(image_paths, args.method, args.size)
+    image_hashes, duplicates = hash_images(
+        counted(chain([first_path], image_paths)), args.method, args.size,
+        args.threshold, _CACHE_PATH if args.cache else None)
+    print('Found', found, 'images')
+    if not image_hashes:
+        return
     print('Found', len(duplicates), 'images with duplicates/similars')
     if not duplicates:
         return
-    print('Total of', end=' ')
-    print(sum(len(dup_list) for dup_list in duplicates.values()), end=' ')
-    print('duplicate/similar image files')
 
     print('Filtering...')
+    total = 0
+    marked = 0
     trash = []
-    for image_hash, paths in duplicates.items():
-        trash.append(filter_duplicates(paths[:], args.filter_mode))
-    print('Marked', end=' ')
-    print(sum(len(image_path) for image_path in trash), end=' ')
-    print('image files for deletion', end='')
-    if not trash:
+    for paths in duplicates.values():
+        total += len(paths)
+        dup_list = filter_duplicates(paths[:], args.filter_mode)
+        marked += len(dup_list)
+        trash.append(dup_list)
+    print('Total of', total, 'duplicate/similar image files')
+    print('Marked', marked, 'image files for deletion', end='')
+    if not marked:
         return
     print(':', end=2*'\n')
     for dup_list in trash:
@@ -160,9 +601,15 @@ def main():
 
     confirm_delete = input('Delete images? (y/n): ')
     if confirm_delete.lstrip().lower().startswith('y'):
-        for dup_list in trash:
-            for duplicate in dup_list:
-                os.remove(duplicate)
+        # Unlinking releases the GIL, so threads overlap the round trips
+        # that each deletion costs on network filesystems.
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = {executor.submit(os.remove, duplicate): duplicate
+                       for dup_list in trash for duplicate in dup_list}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    print('Could not delete', futures[future] + ':',
+                          future.exception())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+from functools import partial
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+import imgsieve
+
+
+def brute_force_groups(hashes, threshold):
+    parent = list(range(len(hashes)))
+
+    def find(index):
+        while parent[index] != index:
+            index = parent[index]
+        return index
+
+    for first in range(len(hashes)):
+        for second in range(first + 1, len(hashes)):
+            if bin(hashes[first] ^ hashes[second]).count('1') <= threshold:
+                parent[find(second)] = find(first)
+
+    groups = {}
+    for index in range(len(hashes)):
+        groups.setdefault(find(index), set()).add(index)
+    return sorted(sorted(group) for group in groups.values()
+                  if len(group) > 1)
+
+
+class FindSimilarTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        for hash_bits in (25, 64):
+            for threshold in (1, 3, 5, 8):
+                hashes = set()
+                for _ in range(40):
+                    base = rng.getrandbits(hash_bits)
+                    hashes.add(base)
+                    for _ in range(3):
+                        variant = base
+                        for _ in range(rng.randint(0, 6)):
+                            variant ^= 1 << rng.randrange(hash_bits)
+                        hashes.add(variant)
+                hashes = list(hashes)
+                image_hashes = {image_hash: [index] for index, image_hash
+                                in enumerate(hashes)}
+
+                for small_bucket, block_words in ((1, 7), (64, 1 << 20)):
+                    saved = (imgsieve._SMALL_BUCKET, imgsieve._BLOCK_WORDS)
+                    imgsieve._SMALL_BUCKET = small_bucket
+                    imgsieve._BLOCK_WORDS = block_words
+                    try:
+                        similar = imgsieve._find_similar(
+                            image_hashes, hash_bits, threshold)
+                    finally:
+                        imgsieve._SMALL_BUCKET, imgsieve._BLOCK_WORDS = saved
+                    self.assertEqual(
+                        sorted(sorted(paths) for paths in similar.values()),
+                        brute_force_groups(hashes, threshold))
+
+    def test_scales_like_one_pass_over_all_pairs(self):
+        rng = random.Random(0)
+        image_hashes = {rng.getrandbits(64): ['x'] for _ in range(10000)}
+        words = imgsieve._to_words(list(image_hashes), 64)
+        start = time.perf_counter()
+        imgsieve._connect(words, 10)
+        all_pairs = time.perf_counter() - start
+
+        for threshold in (5, 10, 20):
+            start = time.perf_counter()
+            imgsieve._find_similar(image_hashes, 64, threshold)
+            self.assertLess(time.perf_counter() - start, 4 * all_pairs)
+
+    def test_threshold_above_hash_bits(self):
+        similar = imgsieve._find_similar({0: ['a'], 0xffff: ['b']}, 16, 16)
+        self.assertEqual(list(similar.values()), [['a', 'b']])
+
+
+class HashBatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        cls.image_paths = []
+        for index, (size, extension) in enumerate(
+                [((64, 48), '.png'), ((100, 100), '.jpg'),
+                 ((37, 91), '.bmp'), ((300, 200), '.png')]):
+            pixels = rng.integers(0, 256, size + (3,), dtype=np.uint8)
+            image_path = os.path.join(cls.directory, str(index) + extension)
+            Image.fromarray(pixels).save(image_path)
+            cls.image_paths.append(image_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assert_matches_imagehash(self, method, hash_function, hash_sizes):
+        for hash_size in hash_sizes:
+            hashed, failed = imgsieve._hash_batch(self.image_paths, method,
+                                                  hash_size)
+            self.assertEqual(failed, [])
+            expected = []
+            for image_path in self.image_paths:
+                with Image.open(image_path) as img:
+                    image_hash = hash_function(img, hash_size)
+                expected.append((image_path, int(str(image_hash), 16)))
+            self.assertEqual(hashed, expected, (method, hash_size))
+
+    def test_matches_imagehash(self):
+        for method, hash_function in [
+                ('ahash', imagehash.average_hash),
+                ('phash', imagehash.phash),
+                ('phash_simple', imagehash.phash_simple),
+                ('dhash', imagehash.dhash),
+                ('dhash_vertical', imagehash.dhash_vertical)]:
+            self.assert_matches_imagehash(method, hash_function, (5, 8, 16))
+
+    def test_whash_matches_imagehash(self):
+        self.assert_matches_imagehash(
+            'whash-db4', partial(imagehash.whash, mode='db4'), (8, 16))
+
+
+class HashImagesTest(unittest.TestCase):
+
+    def test_rejects_threshold_of_all_bits(self):
+        with self.assertRaises(ValueError):
+            imgsieve.hash_images([], hash_size=8, threshold=64)
+
+
+if __name__ == '__main__':
+    unittest.main()